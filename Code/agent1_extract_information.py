@@ -1,10 +1,14 @@
+import asyncio
+import importlib.util
+import itertools
 import json
+import mmap
 import os
-import re
-from openai import OpenAI
-from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Lock
+import httpx
+import orjson
+from openai import AsyncOpenAI
+from tqdm.asyncio import tqdm
+from llm_common import TRANSIENT_ERRORS, backoff_delay, cache_key, submit_batch, wait_for_batch
 
 # ========== CONFIGURATION ==========
 # Before running, specify your input/output file paths and API keys.
@@ -15,63 +19,181 @@ API_KEYS = [
     # Example: "sk-xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx"
 ]
 BASE_URL = "https://api.deepseek.com"
-MAX_WORKERS = min(32, len(API_KEYS) * 2)
+MAX_CONCURRENCY = 64  # Maximum number of in-flight API requests
+MAX_RETRIES = 3       # Retries per request on transient API errors
+# Row marshaling: number of posts analyzed in a single request. Larger values
+# overcome the per-key RPM ceiling at the cost of per-request latency; sweep
+# 1/4/8/16/32 to find the knee for your rate limits. 1 disables marshaling.
+BATCH_ROWS = 8
+WRITE_BUFFER_SIZE = 1 << 20  # Output file buffer size in bytes
+FLUSH_INTERVAL = 2           # Seconds between background flush + fsync of results
+HTTP2 = importlib.util.find_spec("h2") is not None  # HTTP/2 only when h2 is installed
+
+# Batch mode: submit all pending posts as one job to the provider's
+# /v1/batches endpoint instead of one live request per post.
+USE_BATCH_API = False
+BATCH_INPUT_PATH = OUTPUT_PATH + ".batch_input.jsonl"
+BATCH_POLL_INTERVAL = 30  # Seconds between batch status checks
+
+# Cache JSON-bearing responses on disk so re-runs skip them (needs `diskcache`)
+USE_RESPONSE_CACHE = True
+RESPONSE_CACHE_DIR = ".llm_cache"
 
 # ========== INITIALIZATION ==========
-# Compile the JSON object extraction pattern once for efficiency.
-JSON_OBJ_RE = re.compile(r"\{.*\}", re.DOTALL)
+# Reusable decoder for locating the first JSON object in free-form output.
+JSON_DECODER = json.JSONDecoder()
 
-# Initialize OpenAI client pool and a round-robin index.
-clients = [OpenAI(api_key=key, base_url=BASE_URL) for key in API_KEYS]
-client_index = 0
+if USE_RESPONSE_CACHE:
+    import diskcache
+    response_cache = diskcache.Cache(RESPONSE_CACHE_DIR)
+else:
+    response_cache = None
 
-# Thread lock to safely handle file writing and processed ID tracking.
-lock = Lock()
+# Keep-alive connection pool shared by all per-key clients
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_keepalive_connections=64, max_connections=128),
+    http2=HTTP2,
+    timeout=60
+)
+
+# Initialize async OpenAI client pool. All requests run on a single event loop,
+# so a plain cycle is enough for round-robin allocation (no lock required).
+clients = [
+    AsyncOpenAI(api_key=key, base_url=BASE_URL, http_client=http_client, max_retries=0)
+    for key in API_KEYS
+]
+client_cycle = itertools.cycle(clients)
 
 
 def get_client():
     """Return a client instance using round-robin allocation."""
-    global client_index
-    client = clients[client_index]
-    client_index = (client_index + 1) % len(clients)
-    return client
+    return next(client_cycle)
+
 
+SYSTEM_MESSAGE = {"role": "system", "content": ""}
 
-def inference_with_deepseek(prompt: str) -> str:
+
+def build_request_body(prompt: str) -> dict:
+    """Build the chat completion request body shared by live and batch calls."""
+    return {
+        "model": "deepseek-chat",
+        "messages": (SYSTEM_MESSAGE, {"role": "user", "content": prompt}),
+        "temperature": 1.0
+    }
+
+
+async def inference_with_deepseek(prompt: str, parse):
     """
-    Send the given prompt to the DeepSeek API and return the model's response.
-    Each request uses a rotating API client to balance load across keys.
+    Send the given prompt to the DeepSeek API and return parse(response).
+    Each attempt uses a rotating API client to balance load across keys.
+    Transient errors are retried on the next key (see llm_common).
+    A response is cached only if parse accepts it, so an incomplete answer
+    is requested again on the next run.
     """
-    client = get_client()
-    response = client.chat.completions.create(
-        model="deepseek-chat",
-        messages=[
-            {"role": "system", "content": ""},
-            {"role": "user", "content": prompt}
-        ],
-        temperature=1.0
-    )
-    return response.choices[0].message.content
+    body = build_request_body(prompt)
+    key = cache_key(body["model"], body["messages"]) if response_cache is not None else None
+    cached = response_cache.get(key) if key is not None else None
+    if cached is not None:
+        return parse(cached)
 
+    for attempt in range(MAX_RETRIES + 1):
+        client = get_client()
+        try:
+            response = await client.chat.completions.create(**body)
+            break
+        except TRANSIENT_ERRORS as e:
+            if attempt == MAX_RETRIES:
+                raise
+            await asyncio.sleep(backoff_delay(attempt, e))
 
-def extract_round_info(output: str):
+    content = response.choices[0].message.content
+    result = parse(content)
+    if key is not None:
+        response_cache[key] = content
+    return result
+
+
+def strip_code_fence(text: str) -> str:
+    """Remove a surrounding Markdown ```json ... ``` fence with a single slice."""
+    text = text.strip()
+    start = len("```json") if text.startswith("```json") else 0
+    end = len(text) - 3 if text.endswith("```") and len(text) - 3 >= start else len(text)
+    return text[start:end].strip()
+
+
+def first_json_object(text: str) -> dict:
+    """
+    Return the first valid JSON object in text, or {} if there is none.
+    Each candidate '{' is decoded in a single pass with raw_decode, so
+    surrounding prose or nested braces cannot produce a wrong span.
+    """
+    i = text.find('{')
+    while i >= 0:
+        try:
+            obj, _ = JSON_DECODER.raw_decode(text, i)
+            return obj
+        except json.JSONDecodeError:
+            i = text.find('{', i + 1)
+    return {}
+
+
+def parse_json_object(output: str) -> dict:
     """
     Extract and parse the JSON portion from model output.
     Handles both raw JSON and Markdown-style code blocks.
     """
-    text = output.strip()
-    if text.startswith("```json"):
-        text = text[len("```json"):].strip()
-    if text.endswith("```"):
-        text = text[:-3].strip()
+    return first_json_object(strip_code_fence(output))
 
-    try:
-        data = json.loads(text)
-    except Exception:
-        match = JSON_OBJ_RE.search(text)
-        data = json.loads(match.group()) if match else {}
 
-    return data.get("rounds"), data.get("info_by_round")
+def extract_round_info(output: str):
+    """
+    Extract the round count and per-round focus from a single-post response.
+    Raises ValueError if either field is missing.
+    """
+    data = parse_json_object(output)
+    rounds, info = data.get("rounds"), data.get("info_by_round")
+    if rounds is None or info is None:
+        raise ValueError("Response lacks 'rounds' or 'info_by_round'")
+    return rounds, info
+
+
+def extract_batch_info(output: str, n: int) -> dict:
+    """
+    Extract per-post results from a row-marshaled response keyed by post index.
+    Returns {index: (rounds, info_by_round)} for every complete entry;
+    raises ValueError if no entry is complete.
+    """
+    data = parse_json_object(output)
+    results = {}
+    for i in range(n):
+        item = data.get(str(i))
+        if isinstance(item, dict) and item.get("rounds") is not None and item.get("info_by_round") is not None:
+            results[i] = (item["rounds"], item["info_by_round"])
+    if not results:
+        raise ValueError("Batched response holds no complete entry")
+    return results
+
+
+def flush_to_disk(outf):
+    """Flush buffered results and fsync them to disk."""
+    outf.flush()
+    os.fsync(outf.fileno())
+
+
+async def periodic_flush(outf):
+    """Background task: flush buffered results every FLUSH_INTERVAL seconds."""
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        flush_to_disk(outf)
+
+
+def iter_lines(path: str):
+    """Yield the raw byte lines of a file through a read-only memory map."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return  # mmap cannot map an empty file
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield from iter(mm.readline, b"")
 
 
 def load_processed_ids(path: str):
@@ -81,56 +203,85 @@ def load_processed_ids(path: str):
     """
     processed = set()
     if os.path.exists(path):
-        with open(path, 'r', encoding='utf-8') as f:
-            for line in f:
-                try:
-                    processed.add(json.loads(line).get('post_id'))
-                except Exception:
-                    continue
+        for line in iter_lines(path):
+            try:
+                processed.add(orjson.loads(line).get('post_id'))
+            except Exception:
+                continue
     return processed
 
 
+# Static instructions first; only the trailing post content varies between calls.
+PROMPT_PREFIX = """
+You are a compassionate and experienced psychological counselor.
+Analyze the user post below and simulate the planning process
+of a brief therapeutic conversation (1–3 rounds).
+
+Return your output strictly in this JSON format:
+{
+  "rounds": number (1–3),
+  "info_by_round": [list of strings, each describing the focus of one round]
+}
+
+Post content:
+""".lstrip() + '["'
+PROMPT_SUFFIX = '"]'
+
+BATCH_PROMPT_PREFIX = """
+You are a compassionate and experienced psychological counselor.
+Analyze each of the user posts below independently and simulate the planning process
+of a brief therapeutic conversation (1–3 rounds) for each of them.
+
+Return your output strictly as one JSON object keyed by post index, with one entry per post:
+{
+  "0": {
+    "rounds": number (1–3),
+    "info_by_round": [list of strings, each describing the focus of one round]
+  },
+  ...
+}
+
+Posts (index followed by content):
+""".lstrip()
+
+
 def build_prompt(content: str) -> str:
     """
     Build the analysis prompt for the psychological post.
     The model should decide how many conversational rounds are needed (1–3)
     and provide emotional or therapeutic themes for each.
     """
-    return f"""
-You are a compassionate and experienced psychological counselor.
-Analyze the following user post and simulate the planning process
-of a brief therapeutic conversation (1–3 rounds).
+    return ''.join((PROMPT_PREFIX, content, PROMPT_SUFFIX))
 
-Post content:
-["{content}"]
 
-Return your output strictly in this JSON format:
-{{
-  "rounds": number (1–3),
-  "info_by_round": [list of strings, each describing the focus of one round]
-}}
-""".strip()
+def build_batch_prompt(contents) -> str:
+    """
+    Build a single analysis prompt covering several posts (row marshaling).
+    The model must answer with one JSON object keyed by each post's index.
+    """
+    posts_block = "\n".join(f'[{i}] ["{content}"]' for i, content in enumerate(contents))
+    return BATCH_PROMPT_PREFIX + posts_block
 
 
-def main():
+async def run():
     # Load source data and any previously processed post IDs
     posts = json.load(open(INPUT_PATH, 'r', encoding='utf-8'))
     processed_ids = load_processed_ids(OUTPUT_PATH)
 
-    # Open output file in append mode for incremental saving
-    with open(OUTPUT_PATH, 'a', encoding='utf-8') as outf:
-
-        def worker(post):
-            """Thread worker function to process a single post."""
-            pid = post.get('post_id')
-            with lock:
-                if pid in processed_ids:
-                    return
+    # Skip already processed posts up front, so workers never consult processed_ids
+    posts = [p for p in posts if p.get('post_id') not in processed_ids]
+    if not posts:
+        print("No new posts to process.")
+        return
 
-            prompt = build_prompt(post.get('content', ''))
-            try:
-                out = inference_with_deepseek(prompt)
-                rounds, info = extract_round_info(out)
+    # Results are buffered in memory and flushed + fsynced every FLUSH_INTERVAL
+    # seconds by a background task, instead of one write syscall per record.
+    with open(OUTPUT_PATH, 'ab', buffering=WRITE_BUFFER_SIZE) as outf:
+        flusher = asyncio.create_task(periodic_flush(outf))
+        try:
+            def write_result(post, rounds, info):
+                """Append the parsed result for a single post."""
+                pid = post.get('post_id')
                 if rounds is None or info is None:
                     return
 
@@ -141,22 +292,80 @@ def main():
                     "info_by_round": info
                 }
 
-                with lock:
-                    outf.write(json.dumps(result, ensure_ascii=False) + "\n")
-                    outf.flush()
-                    processed_ids.add(pid)
+                outf.write(orjson.dumps(result, option=orjson.OPT_APPEND_NEWLINE))
 
-            except Exception as e:
-                print(f"Error processing post {pid}: {e}")
+            if USE_BATCH_API:
+                # Batch mode: one upload, one poll loop, then demux by custom_id == post_id
+                client = get_client()
+                pending = {str(p.get('post_id')): p for p in posts}
+                job_id = await submit_batch(client, BATCH_INPUT_PATH, (
+                    (cid, build_request_body(build_prompt(p.get('content', '')))) for cid, p in pending.items()
+                ))
+                print(f"Submitted batch {job_id} with {len(pending)} requests")
+                async for custom_id, out in tqdm(wait_for_batch(client, job_id, BATCH_POLL_INTERVAL),
+                                                 total=len(pending), desc="Processing"):
+                    post = pending.get(custom_id)
+                    if post is None:
+                        continue
+                    try:
+                        write_result(post, *extract_round_info(out))
+                    except Exception as e:
+                        print(f"Error processing post {custom_id}: {e}")
 
-        # Multithreading: process all posts concurrently
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            futures = [executor.submit(worker, post) for post in posts]
-            for _ in tqdm(as_completed(futures), total=len(futures), desc="Processing"):
-                pass
+                print(f"All done. Results saved to {OUTPUT_PATH}")
+                return
+
+            async def worker(chunk):
+                """Coroutine worker to process a chunk of up to BATCH_ROWS posts."""
+                # Row marshaling: analyze all posts of the chunk in one request
+                batch_info = {}
+                if len(chunk) > 1:
+                    try:
+                        batch_info = await inference_with_deepseek(
+                            build_batch_prompt([p.get('content', '') for p in chunk]),
+                            lambda out: extract_batch_info(out, len(chunk)),
+                        )
+                    except Exception as e:
+                        print(f"Error processing batch starting at post {chunk[0].get('post_id')}: {e}")
+
+                for i, post in enumerate(chunk):
+                    pid = post.get('post_id')
+                    try:
+                        if i in batch_info:
+                            rounds, info = batch_info[i]
+                        else:
+                            # Fallback: re-issue posts the batched call did not answer
+                            rounds, info = await inference_with_deepseek(
+                                build_prompt(post.get('content', '')), extract_round_info
+                            )
+                        write_result(post, rounds, info)
+                    except Exception as e:
+                        print(f"Error processing post {pid}: {e}")
+                return len(chunk)
+
+            # Bound the number of concurrent requests with a semaphore
+            sem = asyncio.Semaphore(MAX_CONCURRENCY)
+
+            async def bounded(coro):
+                async with sem:
+                    return await coro
+
+            # Process all chunks concurrently on a single event loop
+            tasks = [bounded(worker(posts[i:i + BATCH_ROWS])) for i in range(0, len(posts), BATCH_ROWS)]
+            with tqdm(total=len(posts), desc="Processing", unit="post") as pbar:
+                for task in asyncio.as_completed(tasks):
+                    pbar.update(await task)
+        finally:
+            # Final flush also runs on Ctrl+C, which asyncio.run turns into task cancellation
+            flusher.cancel()
+            flush_to_disk(outf)
 
     print(f"All done. Results saved to {OUTPUT_PATH}")
 
 
+def main():
+    asyncio.run(run())
+
+
 if __name__ == '__main__':
     main()
@@ -1,60 +1,51 @@
+import asyncio
 import json
+import mmap
 import os
 import time
-from openai import OpenAI
+import importlib.util
+import itertools
+import random
+import httpx
+import orjson
+from openai import AsyncOpenAI, OpenAI, APIConnectionError, InternalServerError, RateLimitError
 from tqdm import tqdm
+from llm_common import backoff_delay, cache_key, get_retry_after, submit_batch, wait_for_batch
 import multiprocessing
-from multiprocessing import Pool, Manager
-from functools import partial
+from multiprocessing import Pool
 import signal
 import sys
-from threading import Thread
 
 # ========== CONFIGURATION ==========
 # Before running, specify your input/output file paths and API keys.
 # Do NOT commit actual API keys or local absolute paths to any public repository.
+# API keys are read from the DEEPSEEK_KEYS environment variable (comma-separated);
+# requests are spread round-robin across all keys to avoid per-key rate limits.
 INPUT_PATH = "path/to/input.json"
 OUTPUT_PATH = "path/to/output.json"
+API_KEYS = [key.strip() for key in os.environ.get("DEEPSEEK_KEYS", "").split(",") if key.strip()] or [
+    "sk-xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx",
+]
+BASE_URL = "https://api.deepseek.com"
+DEFAULT_COOLDOWN = 10     # Seconds to rest a key after a 429 without Retry-After
 TEMP_OUTPUT_PATH = OUTPUT_PATH + ".temp"
 MAX_RETRIES = 3           # Maximum retry attempts per record
 PROCESSES = 4             # Number of worker processes (2–3x CPU cores recommended)
-BATCH_SIZE = 25           # Batch size to prevent memory overload
+BATCH_SIZE = 25           # Checkpoint interval (completed records between saves)
+CHUNKSIZE = max(1, BATCH_SIZE // PROCESSES)  # Records sent to a worker per IPC round trip
+HTTP2 = importlib.util.find_spec("h2") is not None
 
+# Batch mode: submit all pending records as one job to the provider's
+# /v1/batches endpoint instead of one live request per record.
+USE_BATCH_API = False
+BATCH_INPUT_PATH = OUTPUT_PATH + ".batch_input.jsonl"
+BATCH_POLL_INTERVAL = 30  # Seconds between batch status checks
 
-# ========== CLIENT INITIALIZATION ==========
-def init_client():
-    """Initialize OpenAI client(s) for each process."""
-    return [
-        OpenAI(
-            api_key="sk-xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx",
-            base_url="https://api.deepseek.com"
-        ),
-    ]
-
-
-# Each process will have its own client instance
-clients = None
-
-
-def init_process():
-    """Initialize OpenAI clients for each process."""
-    global clients
-    clients = init_client()
-
-
-# ========== CORE INFERENCE FUNCTION ==========
-def inference_generate_conversation(post_id, info_by_round, retry_count=0):
-    """
-    Generate a realistic, multi-turn counselor-patient conversation
-    based on the emotional themes extracted from the previous model output.
+# Parsed conversations are cached on disk, one handle per worker (needs `diskcache`)
+USE_RESPONSE_CACHE = True
+RESPONSE_CACHE_DIR = ".llm_cache"
 
-    Each round includes both 'patient' and 'counselor' turns.
-    Retries up to MAX_RETRIES times upon API failure.
-    """
-    global clients
-    current_client = clients[0]  # Single-client mode; can be extended to round-robin
-
-    system_prompt = """
+SYSTEM_PROMPT = """
 You are a compassionate and experienced psychological counselor.
 Your task is to reconstruct a realistic, emotionally attuned multi-turn conversation (up to 3 rounds)
 between a patient and a counselor, based on the emotional themes provided for each round.
@@ -74,152 +65,286 @@ Return JSON with this format:
     ...
   ]
 }
-"""
+""".strip()
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+
+# ========== CLIENT INITIALIZATION ==========
+# One keep-alive connection pool per worker process
+http_client = None
+
+
+def get_http_client():
+    """Return the process-wide pooled HTTP client, creating it on first use."""
+    global http_client
+    if http_client is None:
+        http_client = httpx.Client(
+            limits=httpx.Limits(max_keepalive_connections=64, max_connections=128),
+            http2=HTTP2,
+            timeout=120  # Multi-round generations are long
+        )
+    return http_client
+
+
+def init_client():
+    """Initialize one OpenAI client per API key for each process."""
+    return [
+        OpenAI(api_key=key, base_url=BASE_URL, http_client=get_http_client(), max_retries=0)
+        for key in API_KEYS
+    ]
+
+
+# Each process will have its own client instances, rotation state and cache handle;
+# key cooldowns are shared by all workers so a 429 seen by one is avoided by all.
+clients = None
+response_cache = None
+client_cycle = None
+cool_until = None  # Shared array: key index -> time.monotonic() when the key may be used again
+
+
+def init_process(shared_cool_until):
+    """Initialize OpenAI clients for each process and attach the shared key cooldowns."""
+    global clients, client_cycle, response_cache, cool_until
+    clients = init_client()
+    client_cycle = itertools.cycle(range(len(clients)))
+    cool_until = shared_cool_until
+    if USE_RESPONSE_CACHE:
+        import diskcache
+        response_cache = diskcache.Cache(RESPONSE_CACHE_DIR)
+
+
+def get_client():
+    """
+    Return (index, client) for the next key in round-robin order,
+    skipping keys that are cooling down after a 429 response.
+    """
+    now = time.monotonic()
+    for _ in range(len(clients)):
+        idx = next(client_cycle)
+        if cool_until[idx] <= now:
+            return idx, clients[idx]
+    # Every key is cooling down: wait for the one that recovers first
+    deadlines = cool_until[:]
+    idx = min(range(len(deadlines)), key=deadlines.__getitem__)
+    time.sleep(max(0, deadlines[idx] - now))
+    return idx, clients[idx]
+
 
+def cool_down(idx, error):
+    """Take a rate-limited key out of rotation for its Retry-After period."""
+    with cool_until.get_lock():
+        cool_until[idx] = max(cool_until[idx], time.monotonic() + get_retry_after(error, DEFAULT_COOLDOWN))
+
+
+# ========== CORE INFERENCE FUNCTION ==========
+def build_request_body(info_by_round):
+    """Build the chat completion request body shared by live and batch calls."""
     prompt_payload = {
         "rounds": len(info_by_round),
         "info_by_round": info_by_round
     }
     user_message = f"Input JSON:\n{json.dumps(prompt_payload, ensure_ascii=False)}"
+    return {
+        "model": "deepseek-chat",
+        "messages": (SYSTEM_MESSAGE, {"role": "user", "content": user_message}),
+        "temperature": 1.0
+    }
 
-    try:
-        resp = current_client.chat.completions.create(
-            model="deepseek-chat",
-            messages=[
-                {"role": "system", "content": system_prompt.strip()},
-                {"role": "user", "content": user_message}
-            ],
-            temperature=1.0
-        )
 
-        content = resp.choices[0].message.content.strip()
-        if content.startswith("```json"):
-            content = content[len("```json"):].strip()
-        if content.endswith("```"):
-            content = content[:-3].strip()
+def strip_code_fence(content):
+    """Remove a surrounding Markdown ```json ... ``` fence with a single slice."""
+    content = content.strip()
+    start = len("```json") if content.startswith("```json") else 0
+    end = len(content) - 3 if content.endswith("```") and len(content) - 3 >= start else len(content)
+    return content[start:end].strip()
 
-        conv = json.loads(content)
-        return {
-            "post_id": post_id,
-            "conversation": conv["conversation"]
-        }
 
-    except Exception as e:
-        if retry_count < MAX_RETRIES:
-            time.sleep(1)
-            return inference_generate_conversation(post_id, info_by_round, retry_count + 1)
-        raise Exception(f"API request failed after {MAX_RETRIES} retries: {e}")
+def parse_conversation(post_id, content):
+    """Strip Markdown code fences from the model output and parse the conversation."""
+    conv = json.loads(strip_code_fence(content))
+    return {
+        "post_id": post_id,
+        "conversation": conv["conversation"]
+    }
+
+
+def inference_generate_conversation(post_id, info_by_round):
+    """
+    Generate a realistic, multi-turn counselor-patient conversation
+    based on the emotional themes extracted from the previous model output.
+
+    Each round includes both 'patient' and 'counselor' turns.
+    Transient errors (see llm_common) and unparsable output are retried on the next key.
+    Successfully parsed responses are cached and reused on re-runs.
+    """
+    body = build_request_body(info_by_round)
+    key = cache_key(body["model"], body["messages"]) if response_cache is not None else None
+    cached = response_cache.get(key) if key is not None else None
+    if cached is not None:
+        return parse_conversation(post_id, cached)
+
+    for attempt in range(MAX_RETRIES + 1):
+        idx, current_client = get_client()
+        try:
+            resp = current_client.chat.completions.create(**body)
+            content = resp.choices[0].message.content
+            result = parse_conversation(post_id, content)
+            if key is not None:
+                response_cache[key] = content
+            return result
+
+        except RateLimitError as e:
+            # Cool the key and move on; get_client waits only if every key is cooling
+            cool_down(idx, e)
+            error = e
+            if attempt < MAX_RETRIES:
+                time.sleep(random.random())
+        except (APIConnectionError, InternalServerError, ValueError, KeyError) as e:
+            error = e
+            if attempt < MAX_RETRIES:
+                time.sleep(backoff_delay(attempt, e))
+
+    raise Exception(f"API request failed after {MAX_RETRIES} retries: {error}")
+
+
+# ========== BATCH API ==========
+async def run_batch(records_to_process):
+    """Submit all pending records as one batch job and collect parsed conversations."""
+    client = AsyncOpenAI(api_key=API_KEYS[0], base_url=BASE_URL)
+    pending = {str(rec["post_id"]): rec for rec in records_to_process}
+    job_id = await submit_batch(client, BATCH_INPUT_PATH, (
+        (cid, build_request_body(rec["info_by_round"])) for cid, rec in pending.items()
+    ))
+    print(f"Submitted batch {job_id} with {len(pending)} requests")
+
+    results = []
+    with tqdm(total=len(pending), desc="Generating Conversations") as pbar:
+        async for custom_id, content in wait_for_batch(client, job_id, BATCH_POLL_INTERVAL):
+            pbar.update(1)
+            rec = pending.get(custom_id)
+            if rec is None:
+                continue
+            try:
+                results.append(parse_conversation(rec["post_id"], content))
+            except Exception as e:
+                print(f"\nPost {custom_id} failed: {e}")
+    return results
 
 
 # ========== DATA PROCESSING HELPERS ==========
-def process_record(record, progress_queue=None):
-    """Process a single record and report progress to the queue."""
-    post_id = record["post_id"]
-    info_by_round = record["info_by_round"]
+def process_record(job):
+    """Process a single (post_id, info_by_round) job; returns None on failure."""
+    post_id, info_by_round = job
     try:
-        result = inference_generate_conversation(post_id, info_by_round)
-        if progress_queue:
-            progress_queue.put(1)
-        return result
+        return inference_generate_conversation(post_id, info_by_round)
     except Exception as e:
         print(f"\nPost {post_id} failed: {e}")
-        if progress_queue:
-            progress_queue.put(0)
         return None
 
 
+def iter_lines(path):
+    """Yield the raw byte lines of a file through a read-only memory map."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return  # mmap cannot map an empty file
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield from iter(mm.readline, b"")
+
+
 def load_ndjson(input_path):
     """Load a line-delimited JSON (NDJSON) file into a list of records."""
     records = []
-    with open(input_path, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                records.append(json.loads(line))
-            except json.JSONDecodeError as e:
-                print(f"Failed to parse line: {line[:50]}... Error: {e}")
+    for line in iter_lines(input_path):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            records.append(orjson.loads(line))
+        except orjson.JSONDecodeError as e:
+            print(f"Failed to parse line: {line[:50].decode('utf-8', 'replace')}... Error: {e}")
     return records
 
 
-def load_processed_records(output_path):
-    """
-    Load previously saved results (supports both full JSON and NDJSON formats).
-    Returns: (records, processed_ids)
-    """
-    temp_path = output_path + ".temp"
-    if os.path.exists(temp_path):
-        output_path = temp_path
+def first_byte(path):
+    """Return the first non-whitespace byte of a file, or b"" if there is none."""
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(4096), b""):
+            block = block.lstrip()
+            if block:
+                return block[:1]
+    return b""
 
-    if not os.path.exists(output_path):
-        return [], set()
 
-    records = []
-    processed_ids = set()
+def read_records(path):
+    """Read saved results from a full JSON array or an NDJSON file."""
+    if not os.path.exists(path):
+        return []
 
+    records = []
     try:
-        with open(output_path, "r", encoding="utf-8") as f:
-            content = f.read().strip()
-
-            if content.startswith("["):
+        # Only a full JSON array is read whole; NDJSON goes through a single mmap pass
+        if first_byte(path) == b"[":
+            with open(path, "rb") as f:
                 try:
-                    records = json.loads(content)
-                    processed_ids = {rec["post_id"] for rec in records}
-                    return records, processed_ids
-                except json.JSONDecodeError:
+                    return orjson.loads(f.read())
+                except orjson.JSONDecodeError:
                     pass
 
-            # Fallback: read line by line
-            f.seek(0)
-            for line in f:
-                line = line.strip().rstrip(",")
-                if not line or line in ("[", "]"):
-                    continue
-                try:
-                    record = json.loads(line)
-                    records.append(record)
-                    processed_ids.add(record["post_id"])
-                except json.JSONDecodeError as e:
-                    print(f"Failed to parse line: {line[:50]}... Error: {e}")
-                    continue
+        # Fallback: read line by line
+        for line in iter_lines(path):
+            line = line.strip().rstrip(b",")
+            if not line or line in (b"[", b"]"):
+                continue
+            try:
+                records.append(orjson.loads(line))
+            except orjson.JSONDecodeError as e:
+                print(f"Failed to parse line: {line[:50].decode('utf-8', 'replace')}... Error: {e}")
+                continue
     except Exception as e:
         print(f"Failed to load existing output: {e}")
 
+    return records
+
+
+def load_processed_records(output_path):
+    """
+    Load previously saved results (supports both full JSON and NDJSON formats),
+    merging in records checkpointed to the temp file but not yet compacted.
+    Returns: (records, processed_ids)
+    """
+    records = []
+    processed_ids = set()
+    for path in (output_path, output_path + ".temp"):
+        for record in read_records(path):
+            if record["post_id"] not in processed_ids:
+                records.append(record)
+                processed_ids.add(record["post_id"])
     return records, processed_ids
 
 
-def save_progress(output_path, records):
-    """Save progress to a temporary file, then atomically replace the original."""
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    temp_path = output_path + ".temp"
+def save_progress(temp_path, new_records):
+    """Append only the records completed since the last checkpoint to the NDJSON temp file."""
+    os.makedirs(os.path.dirname(temp_path) or ".", exist_ok=True)
+    with open(temp_path, "ab") as f:
+        for record in new_records:
+            f.write(orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE))
 
-    with open(temp_path, "w", encoding="utf-8") as f:
-        json.dump(records, f, ensure_ascii=False, indent=2)
 
-    if output_path != temp_path:
-        if os.path.exists(output_path):
-            os.remove(output_path)
-        os.rename(temp_path, output_path)
+def compact_output(output_path, records):
+    """Write all records once as a JSON array, atomically replace the output and drop the temp file."""
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    compact_path = output_path + ".compact"
 
+    with open(compact_path, "wb") as f:
+        f.write(orjson.dumps(records, option=orjson.OPT_INDENT_2))
 
-# ========== PROGRESS MONITORING ==========
-def update_progress(progress_queue, total, pbar):
-    """Live update for tqdm progress bar across processes."""
-    success_count = 0
-    fail_count = 0
-    while True:
-        status = progress_queue.get()
-        if status is None:
-            break
-        if status == 1:
-            success_count += 1
-        else:
-            fail_count += 1
-        pbar.set_description(f"Processing (Success: {success_count}, Fail: {fail_count})")
-        pbar.update(1)
+    os.replace(compact_path, output_path)
+    temp_path = output_path + ".temp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
 
 
+# ========== SIGNAL HANDLING ==========
 def signal_handler(sig, frame):
     """Handle interrupt signal (Ctrl+C) and exit gracefully."""
     print("\nInterrupt detected. Saving progress before exit...")
@@ -239,45 +364,55 @@ if __name__ == "__main__":
     records_to_process = [rec for rec in records if rec["post_id"] not in processed_ids]
     print(f"{len(records_to_process)} records remain to process")
 
+    # Multi-bin scheduling: group records by round count (a proxy for output length)
+    # so each chunk sent to a worker is homogeneous, and dispatch the longest bin first
+    # so slow 3-round generations do not straggle at the end of the run.
+    records_to_process.sort(key=lambda rec: len(rec["info_by_round"]), reverse=True)
+
     if not records_to_process:
         print("No new records to process. Exiting.")
         sys.exit(0)
 
-    manager = Manager()
-    progress_queue = manager.Queue()
-    pbar = tqdm(total=len(records_to_process), desc="Generating Conversations")
-
-    progress_thread = Thread(target=update_progress, args=(progress_queue, len(records_to_process), pbar))
-    progress_thread.start()
+    if USE_BATCH_API:
+        # Batch mode: one upload, one poll loop, then demux by custom_id == post_id
+        results = asyncio.run(run_batch(records_to_process))
+        compact_output(OUTPUT_PATH, existing_records + results)
+        print(f"\nProcessing completed. Success: {len(results)}, "
+              f"Fail: {len(records_to_process) - len(results)}")
+        print(f"Results saved to: {OUTPUT_PATH}")
+        sys.exit(0)
 
     results = []
+    pending = []  # Results completed since the last checkpoint
+    fail_count = 0
+    pbar = tqdm(total=len(records_to_process), desc="Generating Conversations")
     try:
-        with Pool(processes=PROCESSES, initializer=init_process) as pool:
-            process_func = partial(process_record, progress_queue=progress_queue)
-
-            for i in range(0, len(records_to_process), BATCH_SIZE):
-                batch = records_to_process[i:i + BATCH_SIZE]
-                batch_results = pool.map(process_func, batch)
-
-                successful_results = [res for res in batch_results if res is not None]
-                results.extend(successful_results)
-
-                combined_records = existing_records + results
-                save_progress(TEMP_OUTPUT_PATH, combined_records)
-
-                print(f"\nProcessed {i + len(batch)}/{len(records_to_process)} records, "
-                      f"successful: {len(successful_results)}")
+        shared_cool_until = multiprocessing.Array("d", len(API_KEYS))
+        with Pool(processes=PROCESSES, initializer=init_process, initargs=(shared_cool_until,)) as pool:
+            # Results stream back through imap_unordered, so progress is
+            # tracked directly in the main process without any IPC queue.
+            # Only the fields a worker needs are pickled, CHUNKSIZE jobs at a time.
+            jobs = [(rec["post_id"], rec["info_by_round"]) for rec in records_to_process]
+            for result in pool.imap_unordered(process_record, jobs, chunksize=CHUNKSIZE):
+                if result is None:
+                    fail_count += 1
+                else:
+                    results.append(result)
+                    pending.append(result)
+                pbar.set_description(f"Processing (Success: {len(results)}, Fail: {fail_count})")
+                pbar.update(1)
+
+                if len(pending) >= BATCH_SIZE:
+                    save_progress(TEMP_OUTPUT_PATH, pending)
+                    pending = []
 
     except Exception as e:
         print(f"\nError during processing: {e}")
 
     finally:
-        progress_queue.put(None)
-        progress_thread.join()
         pbar.close()
 
-        combined_records = existing_records + results
-        save_progress(OUTPUT_PATH, combined_records)
+        compact_output(OUTPUT_PATH, existing_records + results)
 
         print(f"\nProcessing completed. Success: {len(results)}, "
               f"Fail: {len(records_to_process) - len(results)}")
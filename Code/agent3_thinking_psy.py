@@ -1,73 +1,151 @@
 import os
 import json
-import threading
-from openai import OpenAI
-from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio
+import importlib.util
+import itertools
+import time
+import httpx
+from openai import AsyncOpenAI
+from tqdm.asyncio import tqdm
+from llm_common import TRANSIENT_ERRORS, backoff_delay, cache_key
 
 # ========== CONFIGURATION ==========
 # Before releasing publicly:
 # - Replace API keys with placeholders
 # - Use relative paths or environment variables
+HTTP2 = importlib.util.find_spec("h2") is not None
+# Long-lived connection pool; reasoner calls are slow, so the timeout is generous
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_keepalive_connections=64, max_connections=128),
+    http2=HTTP2,
+    timeout=600  # deepseek-reasoner responses can take several minutes
+)
 clients = [
-    OpenAI(api_key="sk-xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx", base_url="https://api.deepseek.com"),
+    AsyncOpenAI(api_key="sk-xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx", base_url="https://api.deepseek.com",
+                http_client=http_client, max_retries=0),
 ]
-MAX_WORKERS = 5  # Number of concurrent threads
+MAX_CONCURRENCY = 5  # Maximum number of in-flight API requests
+MAX_RETRIES = 3      # Retries per request on transient API errors
+WAL_BUFFER_SIZE = 1 << 16  # Write-ahead log buffer size in bytes
+WAL_FLUSH_INTERVAL = 5     # Seconds between flush + fsync of the write-ahead log
+
+# Reasoner replies are slow to regenerate; keep non-empty ones on disk (needs `diskcache`)
+USE_RESPONSE_CACHE = True
+RESPONSE_CACHE_DIR = ".llm_cache"
+if USE_RESPONSE_CACHE:
+    import diskcache
+    response_cache = diskcache.Cache(RESPONSE_CACHE_DIR)
+else:
+    response_cache = None
+
+SYSTEM_PROMPT = (
+    "You are a warm, compassionate, and emotionally attuned psychological counselor. "
+    "Read the client’s message carefully and respond with empathy and emotional understanding.\n\n"
+    "Guidelines:\n"
+    "1. Silently refer to ICD-11 and DSM-5 as background for emotional awareness, "
+    "but never include or imply any diagnostic or technical terms.\n"
+    "2. Suggest one helpful therapeutic approach (e.g., cognitive behavioral, humanistic, psychodynamic, "
+    "family systems, integrative) in simple and relatable language. "
+    "Briefly describe how it may support the client emotionally, without sounding academic.\n"
+    "3. Use a conversational, caring tone. Avoid robotic or formal responses.\n"
+    "4. Keep responses concise: ≤50 words for light input; ≤150 words for emotional depth.\n"
+    "Focus entirely on the client’s emotional needs, not theoretical frameworks."
+)
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
 
 
 # ========== MODEL INFERENCE ==========
-def inference_with_deepseek_r1(text, conversation_history, client):
+async def inference_with_deepseek_r1(messages, client):
     """
     Generate a counselor response based on a single patient input and conversation history.
 
     Args:
-        text (str): Current patient message.
-        conversation_history (list): List of previous conversation turns (role, content).
-        client (OpenAI): Initialized OpenAI API client.
+        messages (list): Fully assembled chat messages:
+                         [system, *previous turns, current patient message].
+        client (AsyncOpenAI): Initialized async OpenAI API client.
 
     Returns:
         tuple[str, str]: (counselor reply, reasoning/thinking text)
+
+    Transient errors are retried with backoff (see llm_common).
+    Non-empty replies are cached and reused on re-runs.
     """
-    system_prompt = (
-        "You are a warm, compassionate, and emotionally attuned psychological counselor. "
-        "Read the client’s message carefully and respond with empathy and emotional understanding.\n\n"
-        "Guidelines:\n"
-        "1. Silently refer to ICD-11 and DSM-5 as background for emotional awareness, "
-        "but never include or imply any diagnostic or technical terms.\n"
-        "2. Suggest one helpful therapeutic approach (e.g., cognitive behavioral, humanistic, psychodynamic, "
-        "family systems, integrative) in simple and relatable language. "
-        "Briefly describe how it may support the client emotionally, without sounding academic.\n"
-        "3. Use a conversational, caring tone. Avoid robotic or formal responses.\n"
-        "4. Keep responses concise: ≤50 words for light input; ≤150 words for emotional depth.\n"
-        "Focus entirely on the client’s emotional needs, not theoretical frameworks."
-    )
-
-    # Combine conversation history and current input
-    full_conversation = [{"role": "user", "content": text}] + conversation_history
-
-    response = client.chat.completions.create(
-        model="deepseek-reasoner",
-        messages=[{"role": "system", "content": system_prompt}] + full_conversation,
-        temperature=1.0
-    )
+    key = cache_key("deepseek-reasoner", messages) if response_cache is not None else None
+    cached = response_cache.get(key) if key is not None else None
+    if cached is not None:
+        return cached
+
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            response = await client.chat.completions.create(
+                model="deepseek-reasoner",
+                messages=messages,
+                temperature=1.0
+            )
+            break
+        except TRANSIENT_ERRORS as e:
+            if attempt == MAX_RETRIES:
+                raise
+            await asyncio.sleep(backoff_delay(attempt, e))
 
     reply = response.choices[0].message.content
     think = response.choices[0].message.reasoning_content  # “Think” reasoning output
+    if key is not None and reply:
+        response_cache[key] = (reply, think)
     return reply, think
 
 
 # ========== FILE I/O ==========
 def write_json_file(filename, posts):
-    """Save JSON data to file in UTF-8 encoding."""
-    with open(filename, "w", encoding="utf-8") as fout:
+    """Save JSON data to file in UTF-8 encoding, atomically replacing any existing file."""
+    temp_file = filename + ".compact"
+    with open(temp_file, "w", encoding="utf-8") as fout:
         json.dump(posts, fout, ensure_ascii=False, indent=2)
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.replace(temp_file, filename)
+
+
+def apply_update(posts, update):
+    """Apply one completed round (counselor reply and reasoning) to the nested posts."""
+    conv = posts[update["post_idx"]]["conversation"][update["conv_idx"]]
+    conv["counselor_content"] = update["counselor_content"]
+    conv["counselor_think"] = update["counselor_think"]  # Store reasoning content separately
+
+
+def append_update(wal, update):
+    """Append one completed round to the write-ahead log (buffered; see flush_wal)."""
+    wal.write(json.dumps(update, ensure_ascii=False) + "\n")
+
+
+def flush_wal(wal):
+    """Flush buffered write-ahead log records and fsync them to disk."""
+    wal.flush()
+    os.fsync(wal.fileno())
+
+
+def replay_updates(filename, posts):
+    """Replay the write-ahead log of an interrupted run into posts. Returns the count."""
+    if not os.path.exists(filename):
+        return 0
+
+    count = 0
+    with open(filename, "r", encoding="utf-8") as fin:
+        for line in fin:
+            try:
+                apply_update(posts, json.loads(line))
+                count += 1
+            except (json.JSONDecodeError, KeyError, IndexError):
+                continue  # Skip a partially written trailing line
+    return count
 
 
 # ========== MAIN PIPELINE ==========
-def main():
+async def run():
     """Main execution pipeline: load data, infer counselor responses, save results."""
     input_file = "path/to/input.json"
     output_file = "path/to/output.json"
+    wal_file = output_file + ".wal"  # Write-ahead log of completed rounds (NDJSON)
 
     # Load input or previously saved progress
     if os.path.exists(output_file):
@@ -77,79 +155,78 @@ def main():
         with open(input_file, "r", encoding="utf-8") as fin:
             posts = json.load(fin)
 
+    # Reconstruct in-memory state: replay rounds completed since the last full save
+    replayed = replay_updates(wal_file, posts)
+
     # Prepare inference tasks
     tasks = []
     for i, post in enumerate(posts):
+        # Running conversation history (excluding reasoning), extended once per round
+        history = [SYSTEM_MESSAGE]
         for j, conv in enumerate(post.get("conversation", [])):
             if not conv.get("counselor_content") and conv.get("patient"):
-                # Build prior conversation history (excluding reasoning)
-                conversation_history = []
-                for prev_conv in post["conversation"][:j]:
-                    if prev_conv.get("counselor_content"):
-                        conversation_history.append({"role": "assistant", "content": prev_conv["counselor_content"]})
-                    if prev_conv.get("patient"):
-                        conversation_history.append({"role": "user", "content": prev_conv["patient"]})
+                tasks.append((i, j, [*history, {"role": "user", "content": conv["patient"]}]))
 
-                tasks.append((i, j, conv["patient"], conversation_history))
+            if conv.get("patient"):
+                history.append({"role": "user", "content": conv["patient"]})
+            if conv.get("counselor_content"):
+                history.append({"role": "assistant", "content": conv["counselor_content"]})
 
     total_tasks = len(tasks)
-    if total_tasks == 0:
+    if total_tasks == 0 and not replayed:
         print("No pending conversation rounds to process.")
         return
 
-    # Thread synchronization
-    file_lock = threading.Lock()
-    client_lock = threading.Lock()
-    client_index = 0
-
-    def get_client():
-        """Rotate among clients safely across threads."""
-        nonlocal client_index
-        with client_lock:
-            c = clients[client_index]
-            client_index = (client_index + 1) % len(clients)
-        return c
-
-    # Concurrent execution
-    update_counter = 0
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor, \
-         tqdm(total=total_tasks, desc="Processing conversation rounds", unit="round") as pbar:
-
-        future_to_task = {
-            executor.submit(
-                inference_with_deepseek_r1,
-                task[2],      # patient text
-                task[3],      # conversation history
-                get_client()  # selected client
-            ): task for task in tasks
-        }
-
-        for future in as_completed(future_to_task):
-            post_idx, conv_idx, _, _ = future_to_task[future]
+    # All requests run on a single event loop, so a plain cycle is enough
+    # for client rotation (no lock required).
+    client_cycle = itertools.cycle(clients)
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+
+    async def worker(task):
+        """Run one inference task under the concurrency limit."""
+        post_idx, conv_idx, messages = task
+        async with sem:
             try:
-                reply, think = future.result()
+                reply, think = await inference_with_deepseek_r1(messages, next(client_cycle))
             except Exception as e:
                 print(f"Error on post {post_idx} conv {conv_idx}: {e}")
-                pbar.update(1)
+                return None
+        return post_idx, conv_idx, reply, think
+
+    # Concurrent execution: each completed round is appended to the WAL
+    # instead of rewriting the whole nested JSON
+    last_flush = time.monotonic()
+    with open(wal_file, "a", buffering=WAL_BUFFER_SIZE, encoding="utf-8") as wal:
+        for future in tqdm.as_completed([worker(task) for task in tasks], total=total_tasks,
+                                        desc="Processing conversation rounds", unit="round"):
+            result = await future
+            if result is None:
                 continue
+            post_idx, conv_idx, reply, think = result
+
+            update = {
+                "post_idx": post_idx,
+                "conv_idx": conv_idx,
+                "counselor_content": reply,
+                "counselor_think": think,
+            }
+            append_update(wal, update)
+            apply_update(posts, update)  # Update in-memory structure
+
+            if time.monotonic() - last_flush >= WAL_FLUSH_INTERVAL:
+                flush_wal(wal)
+                last_flush = time.monotonic()
+        flush_wal(wal)
+
+    # Compaction: write the merged nested JSON once; the WAL is dropped only
+    # after the new output has replaced the old one
+    write_json_file(output_file, posts)
+    os.remove(wal_file)
+    print("All done!")
 
-            # Update in-memory structure
-            conv = posts[post_idx]["conversation"][conv_idx]
-            conv["counselor_content"] = reply
-            conv["counselor_think"] = think  # Store reasoning content separately
-
-            # Periodic auto-save (every 10 updates)
-            update_counter += 1
-            if update_counter % 10 == 0:
-                with file_lock:
-                    write_json_file(output_file, posts)
-
-            pbar.update(1)
 
-    # Final save
-    with file_lock:
-        write_json_file(output_file, posts)
-    print("All done!")
+def main():
+    asyncio.run(run())
 
 
 if __name__ == "__main__":
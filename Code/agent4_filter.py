@@ -1,19 +1,185 @@
+import os
 import json
-import re
-from openai import OpenAI
-from tqdm import tqdm
+import time
+import asyncio
+import importlib.util
+import itertools
+import random
+import fastjsonschema
+import httpx
+import orjson
+from openai import AsyncOpenAI, APIConnectionError, BadRequestError, InternalServerError, RateLimitError
+from tqdm.asyncio import tqdm
+from llm_common import TRANSIENT_ERRORS, backoff_delay, cache_key, get_retry_after, submit_batch, wait_for_batch
 
 # ========== CONFIGURATION ==========
 # Initialize DeepSeek client (replace with your own API key before running)
 # ⚠️ IMPORTANT: Never commit real API keys or local paths to public repositories.
+HTTP2 = importlib.util.find_spec("h2") is not None
+# Connection pool shared by the per-key clients below
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_keepalive_connections=64, max_connections=128),
+    http2=HTTP2,
+    timeout=60,
+)
+
+# API keys are read from the DEEPSEEK_KEYS environment variable (comma-separated);
+# requests are spread round-robin across all keys to avoid per-key rate limits.
+API_KEYS = [key.strip() for key in os.environ.get("DEEPSEEK_KEYS", "").split(",") if key.strip()] or [
+    "sk-xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx",
+]
+# All requests run on a single event loop, so rotation state needs no lock.
 clients = [
-    OpenAI(api_key="sk-xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx", base_url="https://api.deepseek.com"),
+    AsyncOpenAI(api_key=key, base_url="https://api.deepseek.com", http_client=http_client, max_retries=0)
+    for key in API_KEYS
 ]
-current_client_index = 0
+client_cycle = itertools.cycle(range(len(clients)))
+cool_until = {}  # client index -> time.monotonic() when the key may be used again
+MAX_CONCURRENCY = 64   # Maximum number of in-flight API requests
+DEFAULT_COOLDOWN = 10  # Seconds to rest a key after a 429 without Retry-After
+MAX_RETRIES = 3        # Retries per request on transient API errors
+
+# Batch mode: submit all samples as one job to the provider's
+# /v1/batches endpoint instead of one live request per sample.
+USE_BATCH_API = False
+BATCH_POLL_INTERVAL = 30  # Seconds between batch status checks
+
+# Verdicts that parsed cleanly are cached on disk (needs `diskcache`); re-runs skip those requests.
+USE_RESPONSE_CACHE = True
+RESPONSE_CACHE_DIR = ".llm_cache"
+if USE_RESPONSE_CACHE:
+    import diskcache
+    response_cache = diskcache.Cache(RESPONSE_CACHE_DIR)
+else:
+    response_cache = None
+
+# Row marshaling: number of samples reviewed in a single request. The verdicts
+# are short, so 10–20 samples per call are nearly free; sweep 1/4/8/16/32 to
+# find the knee for your rate limits. 1 disables marshaling.
+BATCH_ROWS = 16
+# Chunks are also capped by payload size (characters of sample JSON) so that
+# long multi-turn samples do not overflow the model's context window.
+BATCH_MAX_CHARS = 60_000
+
+REVIEW_CRITERIA = (
+    "You are a meticulous dialogue data quality reviewer for psychological counseling conversations. "
+    "Each sample contains multiple turns with fields: `patient`, `counselor_think`, and `counselor_content`.\n\n"
+    "Identify flawed or unusable samples based on these four criteria:\n"
+    "1. counselor_think is incomplete or lacks analytical clarity.\n"
+    "2. The dialogue is incoherent or contextually inconsistent.\n"
+    "3. counselor_think and counselor_content are mismatched.\n"
+    "4. counselor_think lacks grounding in recognized therapeutic frameworks "
+    "(e.g., cognitive-behavioral, humanistic, psychodynamic) or ICD-11/DSM-5 principles.\n\n"
+)
+
+SYSTEM_PROMPT = REVIEW_CRITERIA + (
+    "Return ONLY a valid JSON object in this exact format:\n"
+    "{\n"
+    "  \"keep\": true/false,\n"
+    "  \"issues\": [list of issue numbers],\n"
+    "  \"reason\": \"brief explanation\"\n"
+    "}\n"
+    "Do not include any commentary, Markdown, or additional text."
+)
+
+# Compiled validators for model verdicts (generated code, checked once per response)
+VERDICT_SCHEMA = {
+    "type": "object",
+    "required": ["keep", "issues", "reason"],
+    "properties": {
+        "keep": {"type": "boolean"},
+        "issues": {"type": "array", "items": {"type": "integer"}},
+        "reason": {"type": "string"},
+    },
+}
+validate_verdict = fastjsonschema.compile(VERDICT_SCHEMA)
+validate_batch_verdict = fastjsonschema.compile({
+    **VERDICT_SCHEMA,
+    "required": VERDICT_SCHEMA["required"] + ["id"],
+    "properties": {**VERDICT_SCHEMA["properties"], "id": {"type": "integer"}},
+})
+
+BATCH_SYSTEM_PROMPT = REVIEW_CRITERIA + (
+    "The input is a JSON object {\"samples\": [{\"id\": ..., \"sample\": {...}}, ...]}. "
+    "Review every sample independently.\n\n"
+    "Return ONLY a valid JSON array with one verdict per sample, in this exact format:\n"
+    "[\n"
+    "  {\n"
+    "    \"id\": sample id,\n"
+    "    \"keep\": true/false,\n"
+    "    \"issues\": [list of issue numbers],\n"
+    "    \"reason\": \"brief explanation\"\n"
+    "  },\n"
+    "  ...\n"
+    "]\n"
+    "Do not include any commentary, Markdown, or additional text."
+)
+
+
+# ========== CLIENT ROTATION ==========
+async def get_client():
+    """
+    Return (index, client) for the next key in round-robin order,
+    skipping keys that are cooling down after a 429 response.
+    """
+    now = time.monotonic()
+    for _ in range(len(clients)):
+        idx = next(client_cycle)
+        if cool_until.get(idx, 0) <= now:
+            return idx, clients[idx]
+    # Every key is cooling down: wait for the one that recovers first
+    idx = min(cool_until, key=cool_until.get)
+    await asyncio.sleep(max(0, cool_until[idx] - now))
+    return idx, clients[idx]
+
+
+def cool_down(idx: int, error):
+    """Take a rate-limited key out of rotation for its Retry-After period."""
+    cool_until[idx] = time.monotonic() + get_retry_after(error, DEFAULT_COOLDOWN)
+
+
+async def create_completion(body: dict):
+    """
+    Send a chat completion request on the next available key.
+    Transient errors are retried on the next key (see llm_common).
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        idx, client = await get_client()
+        try:
+            return await client.chat.completions.create(**body)
+        except RateLimitError as e:
+            # Cool the key and move on; get_client waits only if every key is cooling
+            cool_down(idx, e)
+            if attempt == MAX_RETRIES:
+                raise
+            await asyncio.sleep(random.random())
+        except (APIConnectionError, InternalServerError) as e:
+            if attempt == MAX_RETRIES:
+                raise
+            await asyncio.sleep(backoff_delay(attempt, e))
 
 
 # ========== CORE INFERENCE FUNCTION ==========
-def inference_with_deepseek_v3(sample_json_str: str) -> dict:
+async def cached_completion(body: dict, parse):
+    """
+    Send a request body and return parse(content), answering from the response
+    cache when possible. A response is cached only if parse succeeds, so an
+    invalid or truncated output is requested again on the next run.
+    """
+    key = cache_key(body["model"], body["messages"]) if response_cache is not None else None
+    cached = response_cache.get(key) if key is not None else None
+    if cached is not None:
+        return parse(cached)
+
+    response = await create_completion(body)
+    content = response.choices[0].message.content
+    result = parse(content)
+    if key is not None:
+        response_cache[key] = content
+    return result
+
+
+async def inference_with_deepseek_v3(sample_json_str: str) -> dict:
     """
     Evaluate the quality of multi-turn psychological counseling dialogue samples using DeepSeek.
 
@@ -31,42 +197,69 @@ def inference_with_deepseek_v3(sample_json_str: str) -> dict:
     Notes:
         - The model response is automatically stripped of Markdown code fences.
         - If the response is invalid or incomplete, it defaults to {"keep": False, ...}.
+        - Transient API failures are retried with backoff (see create_completion);
+          if the request still fails, the sample is marked {"keep": False, ...} too.
+          Other API errors (e.g. auth, 400) are raised and abort the run.
     """
-    global current_client_index
-    client = clients[current_client_index]
-    current_client_index = (current_client_index + 1) % len(clients)
-
-    system_prompt = (
-        "You are a meticulous dialogue data quality reviewer for psychological counseling conversations. "
-        "Each sample contains multiple turns with fields: `patient`, `counselor_think`, and `counselor_content`.\n\n"
-        "Identify flawed or unusable samples based on these four criteria:\n"
-        "1. counselor_think is incomplete or lacks analytical clarity.\n"
-        "2. The dialogue is incoherent or contextually inconsistent.\n"
-        "3. counselor_think and counselor_content are mismatched.\n"
-        "4. counselor_think lacks grounding in recognized therapeutic frameworks "
-        "(e.g., cognitive-behavioral, humanistic, psychodynamic) or ICD-11/DSM-5 principles.\n\n"
-        "Return ONLY a valid JSON object in this exact format:\n"
-        "{\n"
-        "  \"keep\": true/false,\n"
-        "  \"issues\": [list of issue numbers],\n"
-        "  \"reason\": \"brief explanation\"\n"
-        "}\n"
-        "Do not include any commentary, Markdown, or additional text."
-    )
-
     # Send request to DeepSeek API
-    response = client.chat.completions.create(
-        model="deepseek-chat",
-        messages=[
+    try:
+        return await cached_completion(build_request_body(sample_json_str), load_verdict)
+    except TRANSIENT_ERRORS as e:
+        # Fallback: Mark as filtered if the request keeps failing
+        return {"keep": False, "issues": [], "reason": f"API request failed: {e}"}
+    except ValueError as e:
+        # Fallback: Mark as filtered if parsing or formatting fails
+        return {"keep": False, "issues": [], "reason": f"Invalid model response: {e}"}
+
+
+async def inference_with_deepseek_v3_batch(sample_json_strs: list) -> list:
+    """
+    Evaluate several samples in a single request (row marshaling).
+
+    Args:
+        sample_json_strs (list[str]): JSON strings of the samples to review together.
+
+    Returns:
+        list[dict]: One verdict per input sample, in input order.
+
+    Notes:
+        - Samples are sent as {"samples": [{"id": i, "sample": {...}}, ...]},
+          spliced from the raw JSON strings without re-encoding them.
+        - Samples are re-issued individually, one at a time, if the batched call
+          fails (including a 400 such as a context overflow) or their verdict is
+          missing or invalid, so a chunk never holds more than one request in flight.
+    """
+    payload = '{"samples":[' + ",".join(
+        f'{{"id":{i},"sample":{sample}}}' for i, sample in enumerate(sample_json_strs)
+    ) + "]}"
+
+    try:
+        verdicts = await cached_completion(build_request_body(payload, BATCH_SYSTEM_PROMPT), parse_batch_verdicts)
+    except (*TRANSIENT_ERRORS, BadRequestError, ValueError, TypeError):
+        verdicts = {}
+
+    # Fallback: re-issue samples the batched call did not answer
+    for i in range(len(sample_json_strs)):
+        if i not in verdicts:
+            verdicts[i] = await inference_with_deepseek_v3(sample_json_strs[i])
+    return [verdicts[i] for i in range(len(sample_json_strs))]
+
+
+def build_request_body(user_content: str, system_prompt: str = SYSTEM_PROMPT) -> dict:
+    """Build the chat completion request body shared by live and batch calls."""
+    return {
+        "model": "deepseek-chat",
+        "messages": [
             {"role": "system", "content": system_prompt},
-            {"role": "user", "content": sample_json_str},
+            {"role": "user", "content": user_content},
         ],
-        temperature=0,
-    )
+        "temperature": 0,
+    }
 
-    result_text = response.choices[0].message.content.strip()
 
-    # Extract JSON if wrapped in Markdown code blocks (```json ... ```)
+def strip_code_fence(result_text: str) -> str:
+    """Extract JSON if wrapped in Markdown code blocks (```json ... ```)."""
+    result_text = result_text.strip()
     if result_text.startswith("```"):
         lines = result_text.splitlines()
         content_lines = []
@@ -75,24 +268,87 @@ def inference_with_deepseek_v3(sample_json_str: str) -> dict:
                 break
             content_lines.append(line)
         result_text = "\n".join(content_lines).strip()
+    return result_text
+
+
+def parse_batch_verdicts(result_text: str) -> dict:
+    """
+    Parse a row-marshaled response into {sample id: verdict}, dropping invalid entries.
+    Raises ValueError if the response holds no valid verdict at all.
+    """
+    verdicts = {}
+    for item in json.loads(strip_code_fence(result_text)):
+        try:
+            validate_batch_verdict(item)
+        except fastjsonschema.JsonSchemaException:
+            continue
+        verdicts[item.pop("id")] = item
+    if not verdicts:
+        raise ValueError("No valid verdict in batched response")
+    return verdicts
+
+
+def load_verdict(result_text: str) -> dict:
+    """Parse and validate the model's quality verdict, raising ValueError if it is invalid."""
+    result_text = strip_code_fence(result_text)
 
     try:
         result = json.loads(result_text)
-        # Validate expected fields
-        if not all(k in result for k in ("keep", "issues", "reason")):
-            raise ValueError("Missing required keys in response JSON.")
+        # Validate expected fields and types
+        validate_verdict(result)
         return result
+    except ValueError as e:
+        raise ValueError(f"{e} | Raw output: {result_text}") from e
 
-    except Exception as e:
+
+def parse_verdict(result_text: str) -> dict:
+    """Parse and validate the model's quality verdict, falling back to a filtered verdict."""
+    try:
+        return load_verdict(result_text)
+    except ValueError as e:
         # Fallback: Mark as filtered if parsing or formatting fails
-        return {
-            "keep": False,
-            "issues": [],
-            "reason": f"Invalid model response: {e} | Raw output: {result_text}",
-        }
+        return {"keep": False, "issues": [], "reason": f"Invalid model response: {e}"}
 
 
 # ========== FILE UTILITIES ==========
+def load_samples(filepath: str) -> list:
+    """
+    Load samples as (post_id, sample_json_str) pairs.
+
+    NDJSON input reuses each raw line as the request payload, skipping a
+    decode/encode round trip; a JSON array is re-encoded once with orjson.
+    """
+    with open(filepath, "rb") as f:
+        data = f.read()
+
+    if data.lstrip().startswith(b"["):
+        return [(post.get("post_id"), orjson.dumps(post).decode("utf-8")) for post in orjson.loads(data)]
+
+    samples = []
+    for line in data.splitlines():
+        line = line.strip()
+        if line:
+            samples.append((orjson.loads(line).get("post_id"), line.decode("utf-8")))
+    return samples
+
+
+def plan_chunks(samples: list) -> list:
+    """
+    Split samples into (start, end) chunks of at most BATCH_ROWS samples and
+    BATCH_MAX_CHARS payload characters. A sample larger than the cap gets its own chunk.
+    """
+    chunks = []
+    start = size = 0
+    for i, (_, sample) in enumerate(samples):
+        if i > start and (i - start == BATCH_ROWS or size + len(sample) > BATCH_MAX_CHARS):
+            chunks.append((start, i))
+            start, size = i, 0
+        size += len(sample)
+    if start < len(samples):
+        chunks.append((start, len(samples)))
+    return chunks
+
+
 def write_json_file(filepath: str, data: list):
     """Write a list of dictionaries to a UTF-8 JSON file with indentation."""
     with open(filepath, "w", encoding="utf-8") as f:
@@ -100,34 +356,77 @@ def write_json_file(filepath: str, data: list):
 
 
 # ========== MAIN EXECUTION ==========
-def main():
+async def run():
     """
     Main pipeline:
-    1. Load multi-turn counseling samples from JSON file.
+    1. Load multi-turn counseling samples from a JSON or NDJSON file.
     2. Evaluate each using DeepSeek quality inference.
     3. Save results (keep flag, issues, reason, post_id) to output file.
     """
     input_file = "path/to/input.json"
     output_file = "path/to/output.json"
 
-    # Load input JSON
-    with open(input_file, "r", encoding="utf-8") as f:
-        posts = json.load(f)
+    # Load input samples as (post_id, raw JSON string) pairs
+    samples = load_samples(input_file)
 
     results = []
-    with tqdm(total=len(posts), desc="Filtering samples", unit="post") as pbar:
-        for post in posts:
-            post_id = post.get("post_id")
-            sample_str = json.dumps(post, ensure_ascii=False)
-            result = inference_with_deepseek_v3(sample_str)
+    if USE_BATCH_API:
+        # Batch mode: one upload, one poll loop, then demux by custom_id == sample index
+        _, client = await get_client()
+        job_id = await submit_batch(
+            client,
+            output_file + ".batch_input.jsonl",
+            ((i, build_request_body(sample)) for i, (_, sample) in enumerate(samples)),
+        )
+        print(f"Submitted batch {job_id} with {len(samples)} requests")
+        verdicts = {}
+        async for custom_id, content in tqdm(wait_for_batch(client, job_id, BATCH_POLL_INTERVAL),
+                                             total=len(samples), desc="Filtering samples", unit="post"):
+            verdicts[custom_id] = content
+        for i, (post_id, _) in enumerate(samples):
+            content = verdicts.get(str(i))
+            if content is None:
+                result = {"keep": False, "issues": [], "reason": "Missing batch response."}
+            else:
+                result = parse_verdict(content)
             result["post_id"] = post_id
             results.append(result)
-            pbar.update(1)
+
+        write_json_file(output_file, results)
+        print(f"✅ Filtering completed. Results saved to: {output_file}")
+        return
+
+    # Every chunk is an independent request; results are stored by input
+    # position, so no locking is needed and the output keeps the input order.
+    results = [None] * len(samples)
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+
+    async def worker(start, end):
+        """Review one chunk of samples under the concurrency limit."""
+        chunk = samples[start:end]
+        sample_strs = [sample for _, sample in chunk]
+        async with sem:
+            if len(chunk) > 1:
+                verdicts = await inference_with_deepseek_v3_batch(sample_strs)
+            else:
+                verdicts = [await inference_with_deepseek_v3(sample_strs[0])]
+        for offset, ((post_id, _), result) in enumerate(zip(chunk, verdicts)):
+            result["post_id"] = post_id
+            results[start + offset] = result
+        return len(chunk)
+
+    with tqdm(total=len(samples), desc="Filtering samples", unit="post") as pbar:
+        for task in asyncio.as_completed([worker(start, end) for start, end in plan_chunks(samples)]):
+            pbar.update(await task)
 
     # Save results
     write_json_file(output_file, results)
     print(f"✅ Filtering completed. Results saved to: {output_file}")
 
 
+def main():
+    asyncio.run(run())
+
+
 if __name__ == "__main__":
     main()
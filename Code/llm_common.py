@@ -0,0 +1,104 @@
+"""
+Helpers shared by the agent scripts in this directory.
+
+Retry policy: API clients are created with max_retries=0 so each agent owns
+its retry loop. Errors in TRANSIENT_ERRORS (rate limits, connection errors
+and 5xx responses) are retried up to the agent's MAX_RETRIES with
+backoff_delay between attempts; any other API error (e.g. 400, auth) is
+raised immediately.
+
+Prompt caching: the agents keep static instructions (system prompts, prompt
+prefixes) in module-level constants placed before any per-request content,
+so every request starts with a byte-identical prefix that the provider's
+context cache can reuse.
+"""
+import asyncio
+import hashlib
+import json
+import random
+
+from openai import APIConnectionError, InternalServerError, RateLimitError
+
+MAX_BACKOFF = 60  # Upper bound (seconds) of the exponential retry backoff
+TRANSIENT_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+
+
+# ========== RETRIES ==========
+def get_retry_after(error, default=None):
+    """Return the Retry-After delay (seconds) of an API error, or default if it has none."""
+    try:
+        return float(error.response.headers["retry-after"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return default
+
+
+def backoff_delay(attempt, error=None):
+    """
+    Exponential backoff with jitter for the given (0-based) retry attempt.
+    Honors the Retry-After header of the error when present.
+    """
+    retry_after = get_retry_after(error)
+    if retry_after is not None:
+        return retry_after + random.random()
+    return min(MAX_BACKOFF, 2 ** attempt) + random.random() * (attempt + 1)
+
+
+# ========== RESPONSE CACHE ==========
+def cache_key(model, messages):
+    """Hash the model and message contents of a request into a response cache key."""
+    parts = [model, *(message["content"] for message in messages)]
+    return hashlib.blake2b("\x00".join(parts).encode("utf-8"), digest_size=16).hexdigest()
+
+
+# ========== BATCH API ==========
+async def submit_batch(client, batch_input_path, requests):
+    """
+    Write (custom_id, request body) pairs to an NDJSON batch file, upload it
+    and create a batch job. Returns the batch job ID.
+    """
+    with open(batch_input_path, "w", encoding="utf-8") as f:
+        for custom_id, body in requests:
+            f.write(json.dumps({
+                "custom_id": str(custom_id),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": body,
+            }, ensure_ascii=False) + "\n")
+
+    with open(batch_input_path, "rb") as f:
+        batch_file = await client.files.create(file=f, purpose="batch")
+    job = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    return job.id
+
+
+async def wait_for_batch(client, job_id, poll_interval):
+    """
+    Poll the batch job until it finishes, then stream-parse its output file.
+    Yields (custom_id, content) for every successful request.
+    The client must use the same API key the job was submitted with.
+    """
+    while True:
+        job = await client.batches.retrieve(job_id)
+        if job.status in ("completed", "failed", "expired", "cancelled"):
+            break
+        await asyncio.sleep(poll_interval)
+
+    if job.status != "completed" or not job.output_file_id:
+        raise RuntimeError(f"Batch {job_id} finished with status '{job.status}'")
+
+    output = await client.files.content(job.output_file_id)
+    for line in output.text.splitlines():
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+            response = record.get("response") or {}
+            if response.get("status_code") != 200:
+                continue
+            yield record["custom_id"], response["body"]["choices"][0]["message"]["content"]
+        except Exception:
+            continue